@@ -1,37 +1,258 @@
 import os
 import sys
+import argparse
+import asyncio
+import io
 import json
+import hashlib
+import datetime
 import subprocess
-import google.generativeai as genai
-from dotenv import load_dotenv
 from rich.console import Console
 from rich.markdown import Markdown
-from rich.prompt import Confirm
 from rich.panel import Panel
-import difflib
+from rich.live import Live
+from rich.text import Text
 import re
+from pathlib import Path
 
 # --- Setup ---
-load_dotenv()
 console = Console()
 
-try:
-    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-    # CORRECTED: Using a current, widely available model
-    model = genai.GenerativeModel('gemini-2.0-flash')
-    chat_model = model.start_chat(history=[])
-except Exception as e:
-    console.print(f"[bold red]Error configuring AI model: {e}[/bold red]")
-    console.print("Please make sure your .env file and API key are set up correctly.")
-    sys.exit(1)
+# The Gemini SDK takes most of a second to import, so it is only loaded by _get_model().
+# It keeps one client (and gRPC channel) per service, so configure() is only ever called
+# once and every request reuses that connection.
+genai = None
+model = None
+json_model = None
+report_model = None
+chat_model = None
+
+def _get_model():
+    """
+    Imports and configures the Gemini SDK on first use, returning the shared model.
+    """
+    global genai, model, json_model, report_model, chat_model
+    if model is not None:
+        return model
+
+    from dotenv import load_dotenv
+    import google.generativeai as genai
+
+    load_dotenv()
+    try:
+        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        # CORRECTED: Using a current, widely available model
+        model = genai.GenerativeModel('gemini-2.0-flash')
+        json_model = genai.GenerativeModel('gemini-2.0-flash', generation_config={"response_mime_type": "application/json"})
+        report_model = genai.GenerativeModel('gemini-2.0-flash', generation_config=REPORT_GENERATION_CONFIG)
+        chat_model = model.start_chat(history=[])
+    except Exception as e:
+        console.print(f"[bold red]Error configuring AI model: {e}[/bold red]")
+        console.print("Please make sure your .env file and API key are set up correctly.")
+        sys.exit(1)
+    return model
+
+# The async gRPC channel cached by the SDK is bound to the event loop it was created on,
+# so all async work runs on this one loop instead of a fresh asyncio.run() per call.
+_event_loop = None
+
+def _run_async(coro):
+    """
+    Runs a coroutine to completion on the shared event loop, creating it on first use.
+    """
+    global _event_loop
+    if _event_loop is None:
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop.run_until_complete(coro)
     
+# Bump whenever a prompt template changes so previously cached responses are no longer used.
+PROMPT_VERSION = "v6"
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "midnight-ai"
+
+# Maximum number of fix requests in flight at once for batch and chunked reviews.
+DEFAULT_CONCURRENCY = 7
+# Files larger than this many characters are reviewed for fixes one chunk at a time.
+CHUNK_THRESHOLD = 30_000
+CHUNK_OVERLAP_LINES = 2
+# Matches string literals and line comments, whose braces do not affect nesting.
+_STRING_OR_COMMENT_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`(?:\\.|[^`\\])*`|//.*')
+# Chat command for pulling another file into the conversation.
+_LOAD_FILE_RE = re.compile(r"^(?:load|read) file (.+)$", re.IGNORECASE)
+
+AUDIT_SECTIONS = [
+    "Security Vulnerabilities",
+    "Privacy Leaks",
+    "Logic Errors",
+    "Line by Line Analysis",
+    "Best Practices",
+    "Recommendations",
+    "Conclusion"
+]
+
+# Constrains the audit report to an object with a string for the contract name and every section.
+REPORT_KEYS = ["Contract Name"] + AUDIT_SECTIONS
+REPORT_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "OBJECT",
+        "properties": {key: {"type": "STRING"} for key in REPORT_KEYS},
+        "required": REPORT_KEYS,
+    },
+}
+
+# Formatting rules for each kind of audit section, shared by the report and per-section prompts.
+LIST_SECTION_FORMAT = """        Return a list of bullet points, where each bullet point starts with a `- `.
+        Keep the text for each bullet point concise and readable.
+        If a bullet point contains a code snippet, place the snippet on a new line and indent it.
+        For example:
+        - This is a finding about a variable.
+          `my_variable` has an issue."""
+
+LINE_BY_LINE_FORMAT = """        Return narrative text formatted with Markdown. **Do not use bullet points for this section.**
+        For each line or block of code you are analyzing, first present the code inside a Markdown code block (using triple backticks).
+        Immediately following the code block, provide your narrative analysis of that code.
+        For example:
+        ```typescript
+        const from = this.owner;
+        ```
+        This line hardcodes the sender to be the contract owner..."""
+
+CONCLUSION_FORMAT = """        Return a single, unbroken line of text with no newlines.
+        The text should be a short, concise paragraph (max 150 words)."""
+
+# --- Result Cache ---
+
+class Cache:
+    """
+    On-disk store of AI responses keyed by a hash of the prompt version, command and code.
+    """
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.enabled = True
+
+    def key(self, command: str, code: str) -> str:
+        return hashlib.sha256("\0".join((PROMPT_VERSION, command, code)).encode()).hexdigest()
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        try:
+            with open(self.directory / f"{key}.json", 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def set(self, key: str, value):
+        if not self.enabled:
+            return
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.directory / f"{key}.json.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self.directory / f"{key}.json")
+        except OSError as e:
+            console.print(f"[dim]Could not write cache entry: {e}[/dim]")
+
+cache = Cache(CACHE_DIR)
+
+# --- Source Upload ---
+
+# Context caches must be created against a versioned model name.
+CONTEXT_CACHE_MODEL = "models/gemini-2.0-flash-001"
+# The API rejects context caches below a minimum token count, so smaller contracts
+# (roughly four characters per token) skip the extra round trip.
+CONTEXT_CACHE_MIN_CHARS = 4096 * 4
+
+class SourceFile:
+    """
+    The contract under review, shared by every audit prompt.
+    Uploading and caching cost several round trips of their own, so they only happen when many prompts
+    will reference the code (`many_prompts`): the code is then uploaded through the File API, and large
+    contracts are also registered as a context cache. Otherwise it is sent inline. Nothing is uploaded
+    until a prompt needs it, so fully cached reviews make no network calls.
+    """
+    def __init__(self, file_path: str, code: str, many_prompts: bool = False):
+        self.file_path = file_path
+        self.code = code
+        self.upload = many_prompts
+        self.uploaded = None
+        self.context_cache = None
+        self.prepared = False
+
+    def _prepare(self):
+        if self.prepared:
+            return
+        self.prepared = True
+        if not self.upload:
+            return
+        try:
+            self.uploaded = genai.upload_file(path=self.file_path, mime_type="text/x-typescript")
+        except Exception as e:
+            console.print(f"[dim]Could not upload {self.file_path}, sending it inline instead: {e}[/dim]")
+            return
+        if len(self.code) < CONTEXT_CACHE_MIN_CHARS:
+            return
+        try:
+            self.context_cache = genai.caching.CachedContent.create(
+                model=CONTEXT_CACHE_MODEL,
+                system_instruction="You are an expert security auditor for Midnight smart contracts.",
+                contents=[self.uploaded],
+                ttl=datetime.timedelta(minutes=10),
+            )
+        except Exception as e:
+            console.print(f"[dim]Could not create context cache, attaching the file instead: {e}[/dim]")
+
+    def model(self, report: bool = False) -> "genai.GenerativeModel":
+        """
+        Returns the model to send this source's prompts to, constrained to the report schema if `report`.
+        """
+        self._prepare()
+        if self.context_cache is not None:
+            generation_config = REPORT_GENERATION_CONFIG if report else None
+            return genai.GenerativeModel.from_cached_content(self.context_cache, generation_config=generation_config)
+        return report_model if report else model
+
+    def attach(self, prompt: str):
+        """
+        Returns the request contents for a prompt that ends by introducing the code.
+        """
+        self._prepare()
+        if self.context_cache is not None:
+            return prompt + " It is provided in the cached context."
+        if self.uploaded is not None:
+            return [prompt + " It is provided in the attached file.", self.uploaded]
+        return f"{prompt}\n```typescript\n{self.code}\n```"
+
+    def delete(self):
+        if self.context_cache is not None:
+            try:
+                self.context_cache.delete()
+            except Exception as e:
+                console.print(f"[dim]Could not delete context cache: {e}[/dim]")
+            self.context_cache = None
+        if self.uploaded is not None:
+            try:
+                genai.delete_file(self.uploaded.name)
+            except Exception as e:
+                console.print(f"[dim]Could not delete uploaded file {self.uploaded.name}: {e}[/dim]")
+            self.uploaded = None
+
 # --- Core Functions ---
 
-def get_ai_fixes(code: str) -> str:
+def _build_fix_prompt(code: str, context_lines: int = 0) -> str:
     """
-    Communicates with the AI model to get fixes for the smart contract code.
+    Builds the prompt asking the AI model for fixes to the smart contract code.
+    When the code is an excerpt of a larger file, its first `context_lines` lines are context only.
     """
-    prompt = f"""
+    excerpt_note = ""
+    if context_lines:
+        excerpt_note = f"""
+      This code is an excerpt of a larger file, so it may start or end partway through a declaration.
+      Line numbers are relative to the excerpt, starting at 1.
+      The first {context_lines} lines are context from the preceding code only: do NOT suggest fixes that change them.
+"""
+    return f"""
       You are an expert security auditor and code refactoring tool for Midnight smart contracts.
       Analyze the following code for security, privacy, logic, and best-practice issues.
       Your response MUST be a valid JSON array of objects. Each object represents a single issue and suggested fix.
@@ -41,223 +262,563 @@ def get_ai_fixes(code: str) -> str:
       - "explanation": A brief, one-sentence explanation of the issue and the fix.
       - "originalCode": The exact original code snippet that needs to be replaced.
       - "suggestedCode": The exact code snippet that should replace the original.
-      If there are no issues, return an empty array [].
+      If there are no issues, return an empty array [].{excerpt_note}
       Here is the code:
       ```typescript
       {code}
       ```
     """
+
+def _report_fix_error(e: Exception):
+    """
+    Prints a helpful message for an error raised while requesting fixes.
+    """
+    error_message = str(e)
+    if "is not found" in error_message or "does not have access" in error_message:
+        console.print("[bold red]AI Model Access Error:[/bold red]")
+        console.print("The configured model is not available for your API key or project.")
+        console.print("1. Ensure billing is enabled on your Google Cloud project.")
+        console.print("2. Check that the 'Generative Language API' (or 'Vertex AI API') is enabled.")
+        console.print(f"3. Verify your project has access to the model being used.")
+        console.print(f"[dim]Details: {error_message}[/dim]")
+    else:
+        console.print(f"[bold red]Error contacting AI model: {e}[/bold red]")
+
+def _decode_fixes(review_data_str: str):
+    """
+    Decodes the JSON array in a fix response, raising json.JSONDecodeError if there is none.
+    """
+    start = max(review_data_str.find('['), 0)
+    # strict=False accepts raw control characters inside strings instead of having to strip them.
+    decoder = json.JSONDecoder(strict=False)
+    fixes, _ = decoder.raw_decode(review_data_str[start:])
+    return fixes
+
+def _cache_fix_response(cache_key: str, review_data_str: str):
+    """
+    Caches a fix response only if it parses, so a malformed reply is retried on the next run.
+    """
     try:
-        response = model.generate_content(prompt)
+        fixes = _decode_fixes(review_data_str)
+    except json.JSONDecodeError:
+        return
+    if isinstance(fixes, list):
+        cache.set(cache_key, review_data_str)
+
+def _fix_cache_key(code: str, context_lines: int) -> str:
+    return cache.key("fix" if not context_lines else f"fix-excerpt-{context_lines}", code)
+
+def get_ai_fixes(code: str, context_lines: int = 0) -> str | None:
+    """
+    Communicates with the AI model to get fixes for the smart contract code.
+    Returns None if the request fails.
+    """
+    cache_key = _fix_cache_key(code, context_lines)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        response = json_model.generate_content(_build_fix_prompt(code, context_lines))
+        _cache_fix_response(cache_key, response.text)
         return response.text
     except Exception as e:
-        error_message = str(e)
-        if "is not found" in error_message or "does not have access" in error_message:
-            console.print("[bold red]AI Model Access Error:[/bold red]")
-            console.print("The configured model is not available for your API key or project.")
-            console.print("1. Ensure billing is enabled on your Google Cloud project.")
-            console.print("2. Check that the 'Generative Language API' (or 'Vertex AI API') is enabled.")
-            console.print(f"3. Verify your project has access to the model being used.")
-            console.print(f"[dim]Details: {error_message}[/dim]")
-        else:
-            console.print(f"[bold red]Error contacting AI model: {e}[/bold red]")
-        return "[]"
+        _report_fix_error(e)
+        return None
+
+async def _get_ai_fixes_async(code: str, context_lines: int = 0) -> str | None:
+    """
+    Async variant of get_ai_fixes, used to issue many fix requests concurrently.
+    """
+    cache_key = _fix_cache_key(code, context_lines)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        response = await json_model.generate_content_async(_build_fix_prompt(code, context_lines))
+        _cache_fix_response(cache_key, response.text)
+        return response.text
+    except Exception as e:
+        _report_fix_error(e)
+        return None
+
+def get_ai_fixes_batch(codes: list, concurrency: int = DEFAULT_CONCURRENCY, context_lines: list | None = None) -> list:
+    """
+    Requests fixes for several pieces of code at once, returning the responses in the same order.
+    At most `concurrency` requests are in flight at a time. `context_lines` optionally gives,
+    per piece of code, how many leading lines are context only (see _build_fix_prompt).
+    """
+    if context_lines is None:
+        context_lines = [0] * len(codes)
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(code, code_context_lines):
+            async with semaphore:
+                return await _get_ai_fixes_async(code, code_context_lines)
+
+        return await asyncio.gather(*(limited(code, n) for code, n in zip(codes, context_lines)))
+    return _run_async(run())
 
 def apply_fixes(file_path: str, fixes: list):
     """
     Applies the suggested fixes to the file after user confirmation.
     """
+    import difflib
+    from rich.prompt import Confirm
+
     if not fixes:
         console.print("[green]✅ No issues found or no fixes suggested.[/green]")
         return
 
-    with open(file_path, 'r') as f:
-        original_code_lines = f.readlines()
-
-    modified_code_lines = list(original_code_lines)
+    # StringIO splits on '\n' only, matching the model's line numbers; str.splitlines would
+    # also split on form feeds, \u2028 and similar characters inside string literals.
+    original_code_lines = io.StringIO(Path(file_path).read_text(encoding="utf-8")).readlines()
 
-    for fix in sorted(fixes, key=lambda x: x['lineNumber'], reverse=True):
+    # Build the modified file in one forward pass instead of splicing each fix into the list.
+    modified_code_lines = []
+    cursor = 0
+    skipped = 0
+    for fix in sorted(fixes, key=lambda x: x['lineNumber']):
         start = fix['lineNumber'] - 1
         end = fix.get('endLineNumber', start + 1) -1
+        if start < cursor or start >= len(original_code_lines):
+            # Overlaps a fix that has already been applied, or lies outside the file.
+            skipped += 1
+            continue
+        # A reversed or overlong range only replaces lines that exist from `start` onwards.
+        end = min(max(end, start), len(original_code_lines) - 1)
         replacement = fix['suggestedCode'].splitlines(True)
         # Ensure we add a newline if the replacement doesn't have one, but the original did
         if replacement and not replacement[-1].endswith('\n') and original_code_lines[end].endswith('\n'):
             replacement[-1] += '\n'
-        modified_code_lines[start : end + 1] = replacement
+        modified_code_lines.extend(original_code_lines[cursor:start])
+        modified_code_lines.extend(replacement)
+        cursor = end + 1
+    modified_code_lines.extend(original_code_lines[cursor:])
+
+    if skipped:
+        console.print(f"[yellow]Skipped {skipped} fix(es) that overlap another fix or fall outside the file.[/yellow]")
+    if modified_code_lines == original_code_lines:
+        console.print("[green]✅ No changes to apply.[/green]")
+        return
 
-    diff = difflib.unified_diff(original_code_lines, modified_code_lines, fromfile=f"a/{file_path}", tofile=f"b/{file_path}")
-    console.print("\n[yellow bold]--- Proposed Changes ---[/yellow bold]")
+    diff = difflib.unified_diff(original_code_lines, modified_code_lines, fromfile=f"a/{file_path}", tofile=f"b/{file_path}", n=2)
+    # Build the whole diff as one styled Text so it is rendered in a single print call.
+    diff_text = Text()
     for line in diff:
-        line = line.strip()
         if line.startswith('+') and not line.startswith('+++'):
-            console.print(f"[green]{line}[/green]")
+            diff_text.append(line.rstrip('\n') + '\n', style="green")
         elif line.startswith('-') and not line.startswith('---'):
-            console.print(f"[red]{line}[/red]")
+            diff_text.append(line.rstrip('\n') + '\n', style="red")
+    console.print("\n[yellow bold]--- Proposed Changes ---[/yellow bold]")
+    console.print(diff_text, end="")
     console.print("[yellow bold]--- End of Changes ---\n[/yellow bold]")
 
     if Confirm.ask("Do you want to apply these fixes?"):
-        with open(file_path, 'w') as f:
-            f.writelines(modified_code_lines)
+        Path(file_path).write_text("".join(modified_code_lines), encoding="utf-8")
         console.print("[green]✅ Fixes applied successfully![/green]")
     else:
         console.print("[gray]Aborted. No changes were made.[/gray]")
 
-def get_ai_audit_section(code: str, section_name: str, contract_name: str) -> str:
+def get_contract_name(source: SourceFile) -> str:
     """
-    Gets a specific section of the AI audit report.
+    Asks the AI model for the name of the smart contract in the code.
     """
-    is_list_section = section_name not in ["Line by Line Analysis", "Conclusion"]
+    cache_key = cache.key("contract-name", source.code)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    contract_name_prompt = "What is the name of the smart contract in this code? Return just the name as a plain string.\n\nHere is the code:"
+    try:
+        response = source.model().generate_content(source.attach(contract_name_prompt))
+        contract_name = response.text.strip()
+    except Exception as e:
+        console.print(f"[bold red]Error getting contract name: {e}[/bold red]")
+        return "Unknown"
+    cache.set(cache_key, contract_name)
+    return contract_name
 
+def _as_markdown(content) -> str:
+    """
+    Converts a report value to Markdown, joining a list of bullet points line by line.
+    """
+    if isinstance(content, list):
+        return "\n".join(_as_markdown(item) for item in content)
+    if content is None:
+        return ""
+    return str(content)
+
+def get_ai_audit_report(source: SourceFile) -> dict[str, str]:
+    """
+    Gets the contract name and every section of the AI audit report in a single request,
+    keyed by "Contract Name" and the section names.
+    """
+    schema = ",\n".join(f'            "{key}": "..."' for key in REPORT_KEYS)
+    prompt = f"""
+      You are an expert security auditor for Midnight smart contracts.
+      Analyze the following code.
+      I want you to provide the name of the smart contract and the content for every section of the audit report.
+
+      Your response MUST be a valid JSON object with exactly these keys, each mapping to a string:
+          {{
+{schema}
+          }}
+
+      "Contract Name" is just the name of the smart contract as a plain string.
+      The remaining keys are Markdown, formatted as follows:
+      - "Security Vulnerabilities", "Privacy Leaks", "Logic Errors", "Best Practices" and "Recommendations":
+{LIST_SECTION_FORMAT}
+      - "Line by Line Analysis":
+{LINE_BY_LINE_FORMAT}
+      - "Conclusion":
+{CONCLUSION_FORMAT}
+
+      In every section, make important words bold using markdown `**word**` and wrap variables in backticks (e.g., `my_variable`).
+      If there are no findings for a section, use an empty string for its value.
+
+      Here is the code:"""
+    cache_key = cache.key("audit-report", source.code)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        response = source.model(report=True).generate_content(source.attach(prompt))
+        report = json.loads(response.text)
+    except Exception as e:
+        console.print(f"[bold red]Error getting audit report: {e}[/bold red]")
+        return {}
+    if not isinstance(report, dict):
+        console.print("[bold red]Error getting audit report: response was not a JSON object.[/bold red]")
+        return {}
+    report = {section_name: _as_markdown(content) for section_name, content in report.items()}
+    cache.set(cache_key, report)
+    return report
+
+def stream_ai_audit_section(source: SourceFile, section_name: str, contract_name: str) -> str:
+    """
+    Generates one section of the AI audit report, rendering it to the console as it streams in.
+    """
     if section_name == "Conclusion":
-        prompt = f"""
-          You are an expert security auditor for Midnight smart contracts.
-          Analyze the following code for the contract named '{contract_name}'.
-          I want you to provide the content for the 'Conclusion' section of the audit report.
-
-          Return your response as a single, unbroken line of text with no newlines.
-          The text should be a short, concise paragraph (max 150 words).
-          Make important words bold using markdown `**word**` and wrap variables in backticks (e.g., `my_variable`).
-          If there are no findings for this section, return an empty string.
-
-          Here is the code:
-          ```typescript
-          {code}
-          ```
-        """
-    elif is_list_section:
-        prompt = f"""
-          You are an expert security auditor for Midnight smart contracts.
-          Analyze the following code for the contract named '{contract_name}'.
-          I want you to provide the content for the '{section_name}' section of the audit report.
-
-          Return your response as a list of bullet points, where each bullet point starts with a `- `.
-          Keep the text for each bullet point concise and readable.
-          If a bullet point contains a code snippet, place the snippet on a new line and indent it.
-          
-          For example:
-          - This is a finding about a variable.
-            `my_variable` has an issue.
-            
-          Make important words bold using markdown `**word**` and wrap variables in backticks (e.g., `my_variable`).
-          If there are no findings for this section, return an empty string.
-
-          Here is the code:
-          ```typescript
-          {code}
-          ```
-        """
-    else: # Narrative section
-        prompt = f"""
-          You are an expert security auditor for Midnight smart contracts.
-          Analyze the following code for the contract named '{contract_name}'.
-          I want you to provide the content for the '{section_name}' section of the audit report.
-
-          Return the response as a single raw string, formatted with Markdown.
-          **Do not use bullet points for this section.**
-
-          For the 'Line by Line Analysis' section, please structure your analysis as follows:
-          - For each line or block of code you are analyzing, first present the code inside a Markdown code block (using triple backticks).
-          - Immediately following the code block, provide your narrative analysis of that code.
-          
-          For example:
-          ```typescript
-          const from = this.owner;
-          ```
-          This line hardcodes the sender to be the contract owner...
-
-          Make important words bold using markdown `**word**` and wrap variables in backticks (e.g., `my_variable`) when mentioned in the narrative text.
-          If there are no findings for this section, return an empty string.
-
-          Here is the code:
-          ```typescript
-          {code}
-          ```
-        """
+        section_format = CONCLUSION_FORMAT
+    elif section_name == "Line by Line Analysis":
+        section_format = LINE_BY_LINE_FORMAT
+    else:
+        section_format = LIST_SECTION_FORMAT
 
+    prompt = f"""
+      You are an expert security auditor for Midnight smart contracts.
+      Analyze the following code for the contract named '{contract_name}'.
+      I want you to provide the content for the '{section_name}' section of the audit report.
+
+{section_format}
+
+      Make important words bold using markdown `**word**` and wrap variables in backticks (e.g., `my_variable`).
+      If there are no findings for this section, return an empty string.
+
+      Here is the code:"""
+    cache_key = cache.key("audit-section", section_name + "\0" + contract_name + "\0" + source.code)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        if cached.strip():
+            console.print(Markdown(cached, code_theme="monokai"))
+        return cached
+
+    section_content_str = ""
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        response = source.model().generate_content(source.attach(prompt), stream=True)
+        with Live(Markdown(""), console=console, refresh_per_second=8) as live:
+            for chunk in response:
+                section_content_str += chunk.text
+                live.update(Markdown(section_content_str, code_theme="monokai"))
     except Exception as e:
         console.print(f"[bold red]Error getting '{section_name}': {e}[/bold red]")
         return ""
+    cache.set(cache_key, section_content_str)
+    return section_content_str
+
+def _parse_fixes(review_data_str: str) -> list | None:
+    """
+    Parses the AI model's fix response, returning None if it is not a valid JSON array.
+    Entries without an integer lineNumber or a string suggestedCode are dropped.
+    """
+    try:
+        fixes = _decode_fixes(review_data_str)
+    except json.JSONDecodeError as e:
+        console.print("[bold red]Error: Could not parse JSON from AI response.[/bold red]")
+        console.print(f"Error: {e}")
+        console.print(f"Raw Response: {review_data_str}")
+        return None
+    if not isinstance(fixes, list):
+        console.print("[bold red]Error: AI response was not a JSON array of fixes.[/bold red]")
+        console.print(f"Raw Response: {review_data_str}")
+        return None
+
+    valid_fixes = []
+    for fix in fixes:
+        if not isinstance(fix, dict) or not isinstance(fix.get('lineNumber'), int) or not isinstance(fix.get('suggestedCode'), str):
+            continue
+        if not isinstance(fix.get('endLineNumber'), int):
+            fix.pop('endLineNumber', None)
+        valid_fixes.append(fix)
+    if len(valid_fixes) < len(fixes):
+        console.print(f"[dim]Ignored {len(fixes) - len(valid_fixes)} malformed fix(es) in the AI response.[/dim]")
+    return valid_fixes
+
+def _apply_fix_response(file_path: str, review_data_str: str):
+    """
+    Parses the AI model's fix response and offers to apply the fixes to the file.
+    """
+    if not review_data_str:
+        console.print("[bold red]Could not get AI review.[/bold red]")
+        return
+    fixes = _parse_fixes(review_data_str)
+    if fixes is not None:
+        apply_fixes(file_path, fixes)
+
+def _split_code(code: str) -> list[tuple[int, int, str]]:
+    r"""
+    Splits code into chunks of roughly CHUNK_THRESHOLD characters, cutting between top-level
+    declarations or class members where possible. Returns (line offset, context lines, chunk)
+    triples, where each chunk after the first starts with up to CHUNK_OVERLAP_LINES lines of
+    the preceding chunk as context.
+
+    >>> code = "".join(f"function f{i}() {{\n  return '}}';\n}}\n" for i in range(2000))
+    >>> chunks = _split_code(code)
+    >>> [(offset, context_lines) for offset, context_lines, _ in chunks]
+    [(0, 0), (2653, 2), (5233, 2)]
+    >>> [chunk.splitlines()[context_lines] for _, context_lines, chunk in chunks[1:]]
+    ['function f885() {', 'function f1745() {']
+    >>> all(chunk == "".join(io.StringIO(code).readlines()[offset:offset + chunk.count("\n")]) for offset, _, chunk in chunks)
+    True
+    """
+    lines = io.StringIO(code).readlines()
+    bounds = []
+    start = 0
+    size = 0
+    depth = 0
+    # Latest line index after which the brace depth is 0 (between declarations)
+    # and at most 1 (between class members), within the current chunk.
+    last_top_cut = None
+    last_member_cut = None
+    for i, line in enumerate(lines):
+        size += len(line)
+        stripped = _STRING_OR_COMMENT_RE.sub('', line)
+        depth = max(depth + stripped.count('{') - stripped.count('}'), 0)
+        if depth == 0:
+            last_top_cut = i + 1
+        if depth <= 1:
+            last_member_cut = i + 1
+        if size > CHUNK_THRESHOLD:
+            if last_top_cut is not None and last_top_cut > start:
+                cut = last_top_cut
+            elif last_member_cut is not None and last_member_cut > start:
+                cut = last_member_cut
+            else:
+                cut = i + 1
+            bounds.append((start, cut))
+            start = cut
+            size = sum(len(l) for l in lines[start:i + 1])
+            last_top_cut = None
+            last_member_cut = None
+    if start < len(lines):
+        bounds.append((start, len(lines)))
+
+    chunks = []
+    for chunk_start, chunk_end in bounds:
+        context_start = max(chunk_start - CHUNK_OVERLAP_LINES, 0)
+        chunks.append((context_start, chunk_start - context_start, "".join(lines[context_start:chunk_end])))
+    return chunks
+
+def get_chunked_fixes(code: str, concurrency: int = DEFAULT_CONCURRENCY) -> list | None:
+    """
+    Requests fixes for each chunk of a large file concurrently and merges them into file line numbers.
+    Returns None if no chunk could be reviewed.
+    """
+    chunks = _split_code(code)
+    responses = get_ai_fixes_batch(
+        [chunk for _, _, chunk in chunks], concurrency,
+        context_lines=[context_lines for _, context_lines, _ in chunks],
+    )
+
+    fixes = []
+    failed_ranges = []
+    dropped_context_fixes = 0
+    for (offset, context_lines, chunk), review_data_str in zip(chunks, responses):
+        chunk_fixes = _parse_fixes(review_data_str) if review_data_str else None
+        if chunk_fixes is None:
+            last_line = offset + chunk.rstrip('\n').count('\n') + 1
+            failed_ranges.append(f"{offset + 1}-{last_line}")
+            continue
+        for fix in chunk_fixes:
+            if fix['lineNumber'] <= context_lines:
+                # The leading context lines belong to the previous chunk, which reviews them itself.
+                dropped_context_fixes += 1
+                continue
+            fix['lineNumber'] += offset
+            if 'endLineNumber' in fix:
+                fix['endLineNumber'] += offset
+            fixes.append(fix)
+
+    if dropped_context_fixes:
+        console.print(f"[dim]Ignored {dropped_context_fixes} fix(es) to context lines shared with a previous chunk.[/dim]")
+    if failed_ranges:
+        console.print(f"[bold red]Could not get AI review for {len(failed_ranges)} of {len(chunks)} chunks (lines {', '.join(failed_ranges)}).[/bold red]")
+        if len(failed_ranges) == len(chunks):
+            return None
+
+    # Chunks overlap by a few lines, so drop any fix that touches lines an earlier fix already replaces.
+    merged = []
+    last_end = 0
+    for fix in sorted(fixes, key=lambda x: x['lineNumber']):
+        if fix['lineNumber'] <= last_end:
+            continue
+        merged.append(fix)
+        last_end = fix.get('endLineNumber', fix['lineNumber'])
+    return merged
+
+def _print_audit_report(source: SourceFile, stream: bool):
+    """
+    Generates and prints the full audit report for the source file.
+    """
+    code = source.code
+
+    if stream:
+        # Each streamed section prompt needs the contract name up front.
+        with console.status("Identifying contract..."):
+            contract_name = get_contract_name(source)
+    else:
+        # The report carries the contract name, so no separate round trip is needed for it.
+        with console.status("Generating audit report..."):
+            report = get_ai_audit_report(source)
+        contract_name = report.get("Contract Name", "").strip() or "Unknown"
+
+    # 1. Main Heading
+    title = f"Security Audit Report - {contract_name} Smart Contract"
+    console.print(Panel(title, style="bold", border_style="blue"), justify="center")
+
+    # 2. Description Text
+    description = f"This report details the findings of a security audit performed on the provided {contract_name} smart contract code. The audit focused on identifying security vulnerabilities, privacy leaks, logic errors, and deviations from best practices."
+    console.print(description, justify="center")
+    console.print() # Spacer
+
+    # 3. Code Snippet
+    console.print("[bold underline]Code Snippet[/bold underline]")
+    console.print(Markdown(f"```typescript\n{code}\n```", code_theme="monokai"))
+    console.print() # Spacer
+
+    # 4. Audit Findings
+    console.print("[bold underline]Audit Findings[/bold underline]", justify="center")
+    console.print() # Spacer
+
+    for i, section_name in enumerate(AUDIT_SECTIONS, 1):
+        console.print(f"[bold]{i}. {section_name}[/bold]", justify="center")
+        if stream:
+            # Streamed sections are rendered while they are generated.
+            section_content_str = stream_ai_audit_section(source, section_name, contract_name)
+        else:
+            section_content_str = report.get(section_name, "")
+            if section_content_str.strip():
+                console.print(Markdown(section_content_str, code_theme="monokai"))
+
+        if not section_content_str.strip():
+            console.print("[dim]No findings for this section.[/dim]")
 
-def review_command(file_path: str, fix: bool):
+        console.print() # Spacer
+
+def review_command(file_path: str, fix: bool, stream: bool = False, concurrency: int = DEFAULT_CONCURRENCY):
     """Handler for the 'review' command."""
+    _get_model()
     console.print(f"[blue]Analyzing {file_path}...[/blue]")
     try:
-        with open(file_path, 'r') as f:
+        with open(file_path, 'r', encoding="utf-8") as f:
             code = f.read()
     except FileNotFoundError:
         console.print(f"[bold red]Error: File not found at '{file_path}'.[/bold red]")
         return
 
     if fix:
-        review_data_str = get_ai_fixes(code)
-        if not review_data_str or review_data_str == "[]":
-            console.print("[bold red]Could not get AI review.[/bold red]")
-            return
-        try:
-            json_str = review_data_str.replace("```json", "").replace("```", "").strip()
-            # Sanitize the JSON response by removing all control characters except for the ones that are allowed in JSON.
-            json_str = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', json_str)
-            fixes = json.loads(json_str)
-            apply_fixes(file_path, fixes)
-        except json.JSONDecodeError as e:
-            console.print("[bold red]Error: Could not parse JSON from AI response.[/bold red]")
-            console.print(f"Error: {e}")
-            console.print(f"Raw Response: {review_data_str}")
+        if len(code) > CHUNK_THRESHOLD:
+            with console.status("Analyzing file in chunks..."):
+                fixes = get_chunked_fixes(code, concurrency)
+            if fixes is not None:
+                apply_fixes(file_path, fixes)
+        else:
+            review_data_str = get_ai_fixes(code)
+            _apply_fix_response(file_path, review_data_str)
     else:
-        # Get contract name
-        with console.status("Identifying contract..."):
-            contract_name_prompt = f"What is the name of the smart contract in this code? Return just the name as a plain string. \n\n```typescript\n{code}\n```"
-            try:
-                response = model.generate_content(contract_name_prompt)
-                contract_name = response.text.strip()
-            except Exception as e:
-                console.print(f"[bold red]Error getting contract name: {e}[/bold red]")
-                contract_name = "Unknown"
-
-        # 1. Main Heading
-        title = f"Security Audit Report - {contract_name} Smart Contract"
-        console.print(Panel(title, style="bold", border_style="blue"), justify="center")
+        # Streaming sends one prompt per section, so the upload is worth it there.
+        source = SourceFile(file_path, code, many_prompts=stream)
+        try:
+            _print_audit_report(source, stream)
+        finally:
+            source.delete()
+def _find_contract_files(dir_path: str) -> list:
+    """
+    Lists the .ts files under a directory, skipping node_modules, hidden directories and .d.ts declarations.
+    """
+    file_paths = []
+    for root, dir_names, file_names in os.walk(dir_path):
+        # Pruning in place stops os.walk from descending into these directories at all.
+        dir_names[:] = [d for d in dir_names if d != "node_modules" and not d.startswith(".")]
+        for file_name in file_names:
+            if file_name.endswith(".ts") and not file_name.endswith(".d.ts"):
+                file_paths.append(os.path.join(root, file_name))
+    return sorted(file_paths)
+
+def review_batch_command(dir_path: str, concurrency: int = DEFAULT_CONCURRENCY):
+    """Handler for 'review <dir> --fix --batch': requests fixes for every contract in a directory at once."""
+    _get_model()
+    file_paths = _find_contract_files(dir_path)
+    if not file_paths:
+        console.print(f"[bold red]Error: No .ts files found in '{dir_path}'.[/bold red]")
+        return
 
-        # 2. Description Text
-        description = f"This report details the findings of a security audit performed on the provided {contract_name} smart contract code. The audit focused on identifying security vulnerabilities, privacy leaks, logic errors, and deviations from best practices."
-        console.print(description, justify="center")
-        console.print() # Spacer
+    codes = {}
+    for file_path in file_paths:
+        try:
+            with open(file_path, 'r', encoding="utf-8") as f:
+                codes[file_path] = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            console.print(f"[bold red]Error reading '{file_path}', skipping it: {e}[/bold red]")
+    if not codes:
+        return
 
-        # 3. Code Snippet
-        console.print("[bold underline]Code Snippet[/bold underline]")
-        console.print(Markdown(f"```typescript\n{code}\n```", code_theme="monokai"))
-        console.print() # Spacer
+    # Small files are all requested together; large ones are split into chunks like a single-file review.
+    small_paths = [p for p, code in codes.items() if len(code) <= CHUNK_THRESHOLD]
+    large_paths = [p for p, code in codes.items() if len(code) > CHUNK_THRESHOLD]
+    with console.status(f"Analyzing {len(codes)} files..."):
+        responses = dict(zip(small_paths, get_ai_fixes_batch([codes[p] for p in small_paths], concurrency)))
+        chunked_fixes = {p: get_chunked_fixes(codes[p], concurrency) for p in large_paths}
+
+    for file_path in codes:
+        console.print(f"\n[blue bold]{file_path}[/blue bold]")
+        if file_path in responses:
+            _apply_fix_response(file_path, responses[file_path])
+        elif chunked_fixes[file_path] is None:
+            console.print("[bold red]Could not get AI review.[/bold red]")
+        else:
+            apply_fixes(file_path, chunked_fixes[file_path])
 
-        # 4. Audit Findings
-        console.print("[bold underline]Audit Findings[/bold underline]", justify="center")
-        console.print() # Spacer
+def _print_chat_response(message: str):
+    """
+    Sends a message to the chat session and renders the reply as it streams in.
+    """
+    response = chat_model.send_message(message, stream=True)
+    console.print("[bold yellow]AI:[/bold yellow]")
+    text = ""
+    with Live(Markdown(""), console=console, refresh_per_second=8) as live:
+        for chunk in response:
+            text += chunk.text
+            live.update(Markdown(text))
 
-        sections = [
-            "Security Vulnerabilities",
-            "Privacy Leaks",
-            "Logic Errors",
-            "Line by Line Analysis",
-            "Best Practices",
-            "Recommendations",
-            "Conclusion"
-        ]
-
-        for i, section_name in enumerate(sections, 1):
-            console.print(f"[bold]{i}. {section_name}[/bold]", justify="center")
-            with console.status(f"Generating {section_name}..."):
-                section_content_str = get_ai_audit_section(code, section_name, contract_name)
-            
-            if section_content_str.strip():
-                console.print(Markdown(section_content_str, code_theme="monokai"))
-            else:
-                console.print("[dim]No findings for this section.[/dim]")
-            
-            console.print() # Spacer
 def chat_command(file_path: str | None = None):
     """Handler for the 'chat' command."""
+    _get_model()
     console.print("[green]Starting interactive chat... (Type 'exit' to quit)[/green]")
 
     initial_prompt = "You are a helpful AI assistant specializing in Midnight smart contracts. Keep your answers concise and clear."
@@ -281,7 +842,7 @@ def chat_command(file_path: str | None = None):
             if user_input.lower() == 'exit':
                 break
 
-            match = re.match(r"^(?:load|read) file (.+)$", user_input.strip(), re.IGNORECASE)
+            match = _LOAD_FILE_RE.match(user_input.strip())
             if match:
                 file_path = match.group(1)
                 try:
@@ -289,10 +850,8 @@ def chat_command(file_path: str | None = None):
                         file_content = f.read()
                     
                     file_prompt = f"The user has requested to load a new file for context:\n\n---\n{file_path}\n---\n\n{file_content}\n\n---"
-                    response = chat_model.send_message(file_prompt)
-                    
                     console.print(f"[blue]Loaded {file_path} into the conversation.[/blue]")
-                    console.print("[bold yellow]AI:[/bold yellow]", Markdown(response.text))
+                    _print_chat_response(file_prompt)
 
                 except FileNotFoundError:
                     console.print(f"[bold red]Error: File not found at '{file_path}'.[/bold red]")
@@ -300,8 +859,7 @@ def chat_command(file_path: str | None = None):
                     console.print(f"[bold red]Error reading file: {e}.[/bold red]")
                 continue
 
-            response = chat_model.send_message(user_input)
-            console.print("[bold yellow]AI:[/bold yellow]", Markdown(response.text))
+            _print_chat_response(user_input)
 
         except KeyboardInterrupt:
             break
@@ -311,29 +869,38 @@ def chat_command(file_path: str | None = None):
     console.print("\n[yellow]Chat session ended.[/yellow]")
 def main():
     """Main function to parse arguments and run commands."""
-    args = sys.argv[1:]
-
-    if not args:
-        console.print("[bold red]Usage: midnight-ai <command> [options][/bold red]")
-        console.print("Commands: review, chat")
-        return
-
-    command = args[0]
-
-    if command == 'review':
-        if len(args) < 2:
-            console.print("[bold red]Usage: midnight-ai review <file> [--fix][/bold red]")
-            return
-        file_path = args[1]
-        fix_flag = '--fix' in args
-        review_command(file_path, fix=fix_flag)
-    elif command == 'chat':
-        if len(args) > 2:
-            console.print("[bold red]Usage: midnight-ai chat [file][/bold red]")
-            return
-        file_path = args[1] if len(args) > 1 else None
-        chat_command(file_path)
-    else:
-        console.print(f"[bold red]Unknown command: {command}[/bold red]")
+    parser = argparse.ArgumentParser(prog="midnight-ai", description="AI-powered assistant for Midnight smart contracts.")
+    subparsers = parser.add_subparsers(dest="cmd", required=True)
+
+    review_parser = subparsers.add_parser("review", help="Review a smart contract.")
+    review_parser.add_argument("file", help="Contract file to review, or a directory when used with --batch.")
+    review_parser.add_argument("--fix", action="store_true", help="Suggest fixes and offer to apply them.")
+    review_parser.add_argument("--no-cache", action="store_true", help="Ignore and do not store cached AI responses.")
+    review_parser.add_argument("--batch", action="store_true", help="With --fix, fix every .ts file in a directory (skipping node_modules, hidden directories and .d.ts files).")
+    review_parser.add_argument("--stream", action="store_true", help="Render each report section as it is generated.")
+    review_parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                               help=f"Maximum concurrent AI requests for batch and chunked fixes (default: {DEFAULT_CONCURRENCY}).")
+
+    chat_parser = subparsers.add_parser("chat", help="Chat about Midnight or a contract.")
+    chat_parser.add_argument("file", nargs="?", help="Optional file to load into the conversation.")
+
+    args = parser.parse_args()
+
+    if args.cmd == 'review':
+        if args.concurrency < 1:
+            review_parser.error("--concurrency must be at least 1")
+        if args.stream and args.fix:
+            review_parser.error("--stream cannot be combined with --fix")
+        cache.enabled = not args.no_cache
+        if args.batch:
+            if not args.fix:
+                review_parser.error("--batch requires --fix")
+            if not os.path.isdir(args.file):
+                review_parser.error("--batch requires a directory")
+            review_batch_command(args.file, concurrency=args.concurrency)
+        else:
+            review_command(args.file, fix=args.fix, stream=args.stream, concurrency=args.concurrency)
+    elif args.cmd == 'chat':
+        chat_command(args.file)
 if __name__ == "__main__":
     main()
\ No newline at end of file